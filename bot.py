@@ -4,124 +4,467 @@ Discord Counting Enforcer Bot
 Manages a counting channel with strict rule enforcement.
 """
 
+import asyncio
+import atexit
+import logging
+import logging.handlers
 import os
-import re
+import queue
 import sys
+from datetime import timedelta
+import aiosqlite
 import discord
+from discord.errors import Forbidden, HTTPException, NotFound
 from discord.ext import commands
 from dotenv import load_dotenv
 
+import counting_core
+
+try:
+    import uvloop
+except ImportError:  # uvloop is unavailable on Windows
+    uvloop = None
+
+logger = logging.getLogger("counting")
+
+# Delete queue tuning
+DELETE_QUEUE_SIZE = 1024
+DELETE_WORKERS = 2
+DELETE_BATCH_MAX = 100  # Bulk delete accepts at most 100 messages
+DELETE_BATCH_WINDOW = 0.5  # Seconds to wait for more messages to batch
+DELETE_BATCH_POLL = 0.05
+BULK_DELETE_MAX_AGE = timedelta(days=14)
+
+# Adaptive delete pacing (seconds between delete attempts)
+DELETE_DELAY_MIN = 0.25
+DELETE_DELAY_MAX = 5.0
+DELETE_DELAY_STEP_UP = 0.15  # Added on every rate limit
+DELETE_DELAY_STEP_DOWN = 0.05  # Removed after a run of successful deletes
+DELETE_OK_THRESHOLD = 20
+
+# Default location of the persisted counting state
+DEFAULT_STATE_DB_PATH = "state.db"
+
+# State save retries (seconds); the delay doubles after each failure
+SAVE_RETRY_DELAY = 0.5
+SAVE_RETRY_MAX = 30.0
+SAVE_CLOSE_TIMEOUT = 10.0  # How long shutdown waits for a pending save
+
+
+def setup_logging():
+    """Route bot logs through a queue so writes happen off the event loop."""
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+class RateLimitFilter(logging.Filter):
+    """Report 429 responses that discord.py retries internally.
+    
+    discord.py sleeps and retries rate-limited requests itself, so callers
+    only see an exception once retries are exhausted. Its HTTP client logs a
+    warning for every 429, which is the one signal available per response.
+    """
+    
+    def __init__(self, callback):
+        super().__init__()
+        self.callback = callback
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if "responded with 429" in str(record.msg):
+            self.callback()
+        return True
+
 
 class CountingBot(commands.Bot):
     """Discord bot for enforcing counting rules."""
     
-    def __init__(self, server_id: int, channel_id: int):
-        intents = discord.Intents.default()
-        intents.message_content = True
+    def __init__(self, server_id: int, channel_id: int, state_db_path: str = DEFAULT_STATE_DB_PATH):
+        # Subscribe only to the events the bot consumes
+        intents = discord.Intents.none()
         intents.guilds = True
-        super().__init__(command_prefix="!", intents=intents)
+        intents.guild_messages = True
+        intents.message_content = True
+        super().__init__(command_prefix="!", intents=intents, chunk_guilds_at_startup=False)
         
         # Configuration from environment variables
         self.server_id = server_id
         self.channel_id = channel_id
+        self.state_db_path = state_db_path
         
         # In-memory state
         self.count = None  # Current count (integer or None)
-        self.previous_author_id = None  # Previous author ID (string or None)
+        self._expected = None  # Next valid count, always count + 1
+        self._expected_str = None  # Decimal form of the next valid count
+        self.previous_author_id = None  # Previous author ID (integer or None)
+        self._state_lock = asyncio.Lock()
+        
+        # Resolved counting channel, cached on ready
+        self._channel = None
+        
+        # Pending deletions, drained by background workers
+        self._delete_q = asyncio.Queue(maxsize=DELETE_QUEUE_SIZE)
+        self._delete_tasks = []
+        self._delete_delay = DELETE_DELAY_MIN
+        self._ok_since_backoff = 0
+        self._can_delete = True  # Cleared once deletes are known to be forbidden
+        self._rate_limit_filter = RateLimitFilter(self._on_rate_limited)
+        
+        # Persistent state, written behind the in-memory state
+        self._db = None
+        self._state_dirty = False
+        self._save_task = None
+        self._saved_count = None  # Last persisted count, the compare-and-swap signature
+        self._unsaved = []  # (count, message) pairs accepted since the last successful save
     
-    async def on_ready(self):
-        """Called when the bot is ready."""
-        print(f"Bot logged in as {self.user}")
-        print(f"Monitoring server ID: {self.server_id}")
-        print(f"Monitoring channel ID: {self.channel_id}")
+    async def setup_hook(self):
+        """Load persisted state and start the delete workers before connecting to the gateway."""
+        await self._load_state()
+        logging.getLogger("discord.http").addFilter(self._rate_limit_filter)
+        for _ in range(DELETE_WORKERS):
+            self._delete_tasks.append(asyncio.create_task(self._delete_worker()))
     
-    async def on_message(self, message: discord.Message):
-        """Handle incoming messages and enforce counting rules.
+    async def close(self):
+        """Flush pending state writes before shutting down."""
+        # Stop the gateway first so no new message can schedule a save
+        await super().close()
+        logging.getLogger("discord.http").removeFilter(self._rate_limit_filter)
+        if self._save_task is not None:
+            try:
+                await asyncio.wait_for(self._save_task, SAVE_CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error("Timed out saving state, count=%s was not persisted", self.count)
+        if self._db is not None:
+            await self._db.close()
+    
+    async def _load_state(self):
+        """Open the state database and restore the saved count, if any."""
+        self._db = await aiosqlite.connect(self.state_db_path)
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "channel_id INTEGER PRIMARY KEY, count INTEGER NOT NULL, prev_author INTEGER, "
+            "last_message INTEGER)"
+        )
+        # Databases created before last_message was tracked lack the column
+        async with self._db.execute("PRAGMA table_info(state)") as cursor:
+            columns = [column[1] for column in await cursor.fetchall()]
+        if "last_message" not in columns:
+            await self._db.execute("ALTER TABLE state ADD COLUMN last_message INTEGER")
+        await self._db.commit()
+        row = await self._fetch_state()
+        if row is not None:
+            self._set_count(row[0])
+            self.previous_author_id = row[1]
+            self._saved_count = row[0]
+            logger.info("State restored: count=%s, author=%s", self.count, self.previous_author_id)
+    
+    async def _fetch_state(self):
+        """Read the persisted (count, prev_author, last_message) row for this channel."""
+        async with self._db.execute(
+            "SELECT count, prev_author, last_message FROM state WHERE channel_id = ?", (self.channel_id,)
+        ) as cursor:
+            return await cursor.fetchone()
+    
+    def _schedule_save(self, message: discord.Message):
+        """Persist the current state in the background.
         
-        Rules enforced (after initialization):
-        1. Strict numeric check - ASCII digits only (0-9)
-        2. Increment check - must equal count + 1
-        3. Author lock - must differ from previous author
+        Writes are coalesced: while a save is in flight, further updates only
+        mark the state dirty and the running task writes the latest values.
+        The accepted message is kept until its state is saved.
+        """
+        self._unsaved.append((self.count, message))
+        self._state_dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._save_state())
+    
+    async def _save_state(self):
+        """Write the in-memory state until no newer update is pending.
         
-        Invalid messages are deleted. State updates only on success.
+        Each write is a compare-and-swap on the last saved count, so another
+        instance sharing the database cannot have its progress overwritten.
+        Failed writes are retried with backoff, keeping the accepted messages
+        for reconciliation.
         """
-        # Ignore bot's own messages
-        if message.author == self.user:
-            return
+        retry_delay = SAVE_RETRY_DELAY
+        while self._state_dirty:
+            self._state_dirty = False
+            count, author = self.count, self.previous_author_id
+            accepted, self._unsaved = self._unsaved, []
+            last_message = accepted[-1][1].id
+            try:
+                if self._saved_count is None:
+                    cursor = await self._db.execute(
+                        "INSERT OR IGNORE INTO state (channel_id, count, prev_author, last_message) "
+                        "VALUES (?, ?, ?, ?)",
+                        (self.channel_id, count, author, last_message),
+                    )
+                else:
+                    cursor = await self._db.execute(
+                        "UPDATE state SET count = ?, prev_author = ?, last_message = ? "
+                        "WHERE channel_id = ? AND count = ?",
+                        (count, author, last_message, self.channel_id, self._saved_count),
+                    )
+                await self._db.commit()
+            except aiosqlite.Error as e:
+                logger.error("Failed to save state: %s", e)
+                await self._rollback()
+                self._unsaved = accepted + self._unsaved
+                self._state_dirty = True
+                saved = False
+            else:
+                if cursor.rowcount == 1:
+                    self._saved_count = count
+                    saved = True
+                else:
+                    saved = await self._resync_state(accepted)
+            
+            if saved:
+                retry_delay = SAVE_RETRY_DELAY
+            else:
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, SAVE_RETRY_MAX)
+    
+    async def _rollback(self):
+        """Discard a transaction left open by a failed write."""
+        try:
+            await self._db.rollback()
+        except aiosqlite.Error as e:
+            logger.error("Failed to roll back state write: %s", e)
+    
+    async def _resync_state(self, accepted: list) -> bool:
+        """Reconcile with the persisted state after losing a compare-and-swap.
         
-        # Only process messages from the specified server and channel
-        if message.guild is None or message.guild.id != self.server_id:
-            return
+        Instances watching the same channel accept the same messages, so the
+        stored state usually points at a message accepted here too; the local
+        counts after it are kept and written on top. Otherwise the stored
+        state is adopted and only the local counts it contradicts are deleted.
         
-        if message.channel.id != self.channel_id:
-            return
+        Returns False if the stored state could not be read; the accepted
+        messages are then put back so a retry can still reconcile them.
+        """
+        try:
+            row = await self._fetch_state()
+        except aiosqlite.Error as e:
+            logger.error("Failed to reload state: %s", e)
+            self._unsaved = accepted + self._unsaved
+            self._state_dirty = True
+            return False
+        # No awaits below, so nothing can be accepted against the stale state
+        pending = accepted + self._unsaved
+        if row is None:
+            # The row was removed; write the local state afresh
+            self._saved_count = None
+            self._unsaved = pending
+            self._state_dirty = True
+            return True
         
-        # Get message content
-        content = message.content.strip()
+        stored_count, stored_author, stored_message = row
+        start = counting_core.reconcile([(count, m.id) for count, m in pending], stored_count, stored_message)
+        if start >= 0:
+            self._saved_count = stored_count
+            self._unsaved = pending[start:]
+            self._state_dirty = bool(self._unsaved)
+            return True
         
-        # Handle empty messages
-        if not content:
-            if self.count is not None:
-                try:
-                    await message.delete()
-                except (discord.errors.Forbidden, discord.errors.NotFound):
-                    print(f"Failed to delete message {message.id}")
+        logger.warning("State was changed by another instance, reloading")
+        for count, message in pending:
+            if count >= stored_count:
+                self._queue_delete(message)
+        self._unsaved = []
+        self._state_dirty = False
+        self._set_count(stored_count)
+        self.previous_author_id = stored_author
+        self._saved_count = stored_count
+        logger.info("State reloaded: count=%s, author=%s", self.count, self.previous_author_id)
+        return True
+    
+    def _queue_delete(self, message: discord.Message):
+        """Schedule a message for deletion without blocking the event handler."""
+        if not self._can_delete:
             return
+        try:
+            self._delete_q.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning("Delete queue full, dropping message %s", message.id)
+    
+    async def _delete_worker(self):
+        """Delete queued messages in batches with adaptive pacing.
         
-        # Rule 1: Strict numeric check - content must consist strictly of ASCII digits
-        # Using regex ensures only 0-9 digits are accepted (excludes Unicode digits)
-        if not re.match(r'^[0-9]+$', content):
-            if self.count is not None:  # Only delete if state is initialized
+        Messages queued within a short window are coalesced into a single
+        bulk delete. The delay between attempts grows on every rate limit
+        and shrinks slowly after a run of successful deletes.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._delete_q.get()]
+            deadline = loop.time() + DELETE_BATCH_WINDOW
+            while len(batch) < DELETE_BATCH_MAX and loop.time() < deadline:
                 try:
-                    await message.delete()
-                except (discord.errors.Forbidden, discord.errors.NotFound):
-                    print(f"Failed to delete message {message.id}")
+                    batch.append(self._delete_q.get_nowait())
+                except asyncio.QueueEmpty:
+                    await asyncio.sleep(DELETE_BATCH_POLL)
+            try:
+                await self._delete_batch(batch)
+            except Exception:
+                # Keep the worker alive; a dead worker stops all enforcement
+                logger.exception("Failed to delete %s queued messages", len(batch))
+            finally:
+                for _ in batch:
+                    self._delete_q.task_done()
+    
+    async def _delete_batch(self, batch: list):
+        """Bulk delete a batch, falling back to one request per message."""
+        if not self._can_delete:
             return
+        # The bulk endpoint rejects messages older than 14 days
+        cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        recent = [m for m in batch if m.created_at > cutoff]
+        if len(recent) > 1:
+            channel = self._channel or recent[0].channel
+            if await self._paced_delete(channel.delete_messages(recent), f"{len(recent)} messages"):
+                batch = [m for m in batch if m.created_at <= cutoff]
+        for message in batch:
+            if not self._can_delete:
+                return
+            await self._paced_delete(message.delete(), f"message {message.id}")
+    
+    async def _paced_delete(self, request, description: str) -> bool:
+        """Await a delete request and sleep for the adaptive delay.
         
-        # Parse the integer (guaranteed to be positive due to regex)
-        parsed_number = int(content)
+        Returns True if the request succeeded.
+        """
+        ok = False
+        try:
+            await request
+            ok = True
+            self._ok_since_backoff += 1
+            if self._ok_since_backoff >= DELETE_OK_THRESHOLD:
+                self._delete_delay = max(DELETE_DELAY_MIN, self._delete_delay - DELETE_DELAY_STEP_DOWN)
+                self._ok_since_backoff = 0
+        except Forbidden:
+            if self._can_delete:
+                self._can_delete = False
+                logger.error("Missing permission to delete messages, disabling deletes")
+        except NotFound:
+            logger.warning("Failed to delete %s", description)
+        except HTTPException as e:
+            logger.warning("Failed to delete %s: %s", description, e)
+        except Exception:
+            # Network errors discord.py re-raises after its own retries
+            logger.exception("Failed to delete %s", description)
+        await asyncio.sleep(self._delete_delay)
+        return ok
+    
+    def _on_rate_limited(self):
+        """Slow down deletes after discord.py reports a 429."""
+        self._delete_delay = min(DELETE_DELAY_MAX, self._delete_delay + DELETE_DELAY_STEP_UP)
+        self._ok_since_backoff = 0
+    
+    async def on_ready(self):
+        """Called when the bot is ready."""
+        logger.info("Bot logged in as %s", self.user)
+        logger.info("Monitoring server ID: %s", self.server_id)
+        logger.info("Monitoring channel ID: %s", self.channel_id)
+        channel = self.get_channel(self.channel_id)
+        self._channel = channel if self._is_counting_channel(channel) else None
         
-        # Initial state handling
-        if self.count is None:
-            # First valid message initializes the state (not deleted)
-            self.count = parsed_number
-            self.previous_author_id = str(message.author.id)
-            print(f"State initialized: count={self.count}, author={self.previous_author_id}")
-            return
+        # Re-check permissions so a fixed role re-enables deletes
+        if self._channel is not None:
+            perms = self._channel.permissions_for(self._channel.guild.me)
+            self._can_delete = perms.manage_messages
+            if not self._can_delete:
+                logger.error("Missing Manage Messages permission in the counting channel")
+    
+    def _set_count(self, count: int):
+        """Set the current count and precompute the next expected value."""
+        self.count = count
+        self._expected = count + 1
+        self._expected_str = str(self._expected)
+    
+    def _is_counting_channel(self, channel) -> bool:
+        """Check a channel against the configured server and channel IDs."""
+        if channel is None or channel.id != self.channel_id:
+            return False
+        guild = getattr(channel, "guild", None)
+        return guild is not None and guild.id == self.server_id
+    
+    async def on_message(self, message: discord.Message):
+        """Handle incoming messages, logging any unexpected error."""
+        try:
+            await self._handle_message(message)
+        except Exception as e:
+            logger.exception("on_message failed: %s", e)
+    
+    async def _handle_message(self, message: discord.Message):
+        """Enforce counting rules on a single message.
         
-        # Rule 2: Increment check - must equal count + 1
-        if parsed_number != self.count + 1:
-            try:
-                await message.delete()
-            except (discord.errors.Forbidden, discord.errors.NotFound):
-                print(f"Failed to delete message {message.id}")
-            return
+        Rules enforced (after initialization):
+        1. Strict numeric check - ASCII digits only (0-9)
+        2. Increment check - must equal count + 1
+        3. Author lock - must differ from previous author
         
-        # Rule 3: Author lock - author must not be the same as previous
-        current_author_id = str(message.author.id)
-        if current_author_id == self.previous_author_id:
-            try:
-                await message.delete()
-            except (discord.errors.Forbidden, discord.errors.NotFound):
-                print(f"Failed to delete message {message.id}")
+        Invalid messages are queued for deletion. State updates only on success.
+        """
+        # Ignore messages from bots (including this one) and webhooks
+        if message.author.bot:
             return
         
-        # All rules passed - update state
-        self.count = parsed_number
-        self.previous_author_id = current_author_id
-        print(f"State updated: count={self.count}, author={self.previous_author_id}")
+        # Only process messages from the specified channel and server.
+        # Identity against the cached channel is the fast path; fall back to
+        # a full check and refresh the cache if the channel object was replaced.
+        channel = message.channel
+        if channel is not self._channel:
+            if channel.id != self.channel_id or not self._is_counting_channel(channel):
+                return
+            self._channel = channel
+        
+        # Content is checked as sent; whitespace fails the numeric check
+        content = message.content
+        
+        # Check-and-set under the lock so the author lock holds even if
+        # messages are ever handled concurrently. Nothing inside awaits.
+        async with self._state_lock:
+            # Initial state handling: the first positive count, written without
+            # leading zeros, initializes the state (not deleted); anything
+            # else is ignored until then
+            if self.count is None:
+                if counting_core.is_count(content) and content[0] != "0":
+                    self._set_count(int(content))
+                    self.previous_author_id = message.author.id
+                    self._schedule_save(message)
+                    logger.info("State initialized: count=%s, author=%s", self.count, self.previous_author_id)
+                return
+            
+            current_author_id = message.author.id
+            if not counting_core.validate(content, self._expected_str, self.previous_author_id, current_author_id):
+                self._queue_delete(message)
+                return
+            
+            # All rules passed - update state
+            self._set_count(self._expected)
+            self.previous_author_id = current_author_id
+            self._schedule_save(message)
+            logger.info("State updated: count=%s, author=%s", self.count, self.previous_author_id)
 
 
 def main():
     """Main entry point."""
     load_dotenv() # Load environment variables from .env file
+    setup_logging()
 
     # Validate required environment variables
     required_vars = ["DISCORD_TOKEN", "DISCORD_SERVER_ID", "COUNTING_CHANNEL_ID"]
     missing_vars = [var for var in required_vars if var not in os.environ]
     
     if missing_vars:
-        print(f"Error: Missing required environment variables: {', '.join(missing_vars)}")
+        logger.error("Missing required environment variables: %s", ", ".join(missing_vars))
         sys.exit(1)
     
     # Get Discord token and IDs
@@ -131,19 +474,34 @@ def main():
         server_id = int(os.environ["DISCORD_SERVER_ID"])
         channel_id = int(os.environ["COUNTING_CHANNEL_ID"])
     except ValueError as e:
-        print(f"Error: Invalid integer value in environment variables ({e})")
+        logger.error("Invalid integer value in environment variables (%s)", e)
         sys.exit(1)
     
+    state_db_path = os.environ.get("STATE_DB_PATH", DEFAULT_STATE_DB_PATH)
+    
     # Create and run bot
-    bot = CountingBot(server_id, channel_id)
+    bot = CountingBot(server_id, channel_id, state_db_path)
+    
+    async def runner():
+        async with bot:
+            await bot.start(token)
+    
+    # Same log setup bot.run() would apply to discord.py's own logger
+    discord.utils.setup_logging(root=False)
     
     try:
-        bot.run(token)
+        # Use the libuv-based event loop when available
+        if uvloop is not None:
+            uvloop.run(runner())
+        else:
+            asyncio.run(runner())
+    except KeyboardInterrupt:
+        pass
     except discord.errors.LoginFailure:
-        print("Error: Invalid Discord token")
+        logger.error("Invalid Discord token")
         sys.exit(1)
     except Exception as e:
-        print(f"Error: Bot failed to start: {e}")
+        logger.error("Bot failed to start: %s", e)
         sys.exit(1)
 
 
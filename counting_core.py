@@ -0,0 +1,45 @@
+"""
+Counting rule checks used on every message, and reconciliation of saved state.
+Kept free of discord.py so the Docker build can compile it with mypyc.
+"""
+
+from typing import List, Optional, Tuple
+
+
+def is_count(content: str) -> bool:
+    """Return True if content consists strictly of ASCII digits (0-9)."""
+    # isascii() excludes Unicode digits that isdigit() alone would accept,
+    # and isdigit() is False for empty content
+    return content.isascii() and content.isdigit()
+
+
+def validate(content: str, expected: str, previous_author: Optional[int], author: int) -> bool:
+    """Check a message against the counting rules.
+
+    `expected` is the decimal form of the next count. Returns True if every
+    rule passes.
+    """
+    # Rule 1: Strict numeric check
+    if not is_count(content):
+        return False
+
+    # Rule 2: Increment check - must equal count + 1, written canonically
+    if content != expected:
+        return False
+
+    # Rule 3: Author lock - author must not be the same as previous
+    return author != previous_author
+
+
+def reconcile(accepted: List[Tuple[int, int]], stored_count: int, stored_message: Optional[int]) -> int:
+    """Locate the state another instance stored among locally accepted counts.
+
+    `accepted` holds (count, message_id) pairs in the order they were
+    accepted. Returns the index just past the pair matching the stored
+    count and message, so the local counts from there on extend the stored
+    state, or -1 if the stored state is not one of them.
+    """
+    for i, (count, message_id) in enumerate(accepted):
+        if count == stored_count:
+            return i + 1 if message_id == stored_message else -1
+    return -1
@@ -0,0 +1,79 @@
+"""
+Tests for the background delete workers and their rate limit pacing.
+Run with: python -m unittest discover tests
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+
+import bot
+from bot import CountingBot
+
+
+class FakeMessage(SimpleNamespace):
+    """Stand-in for a discord.Message whose delete() may raise."""
+
+    def __init__(self, message_id: int, error: Exception = None):
+        super().__init__(id=message_id, created_at=discord.utils.utcnow(), deleted=False, error=error)
+
+    async def delete(self):
+        if self.error is not None:
+            raise self.error
+        self.deleted = True
+
+
+class DeleteWorkerTests(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bot = CountingBot(1, 2, os.path.join(self.tmp.name, "state.db"))
+        self.bot._delete_delay = 0
+        patcher = mock.patch.object(bot, "DELETE_BATCH_WINDOW", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.worker = asyncio.create_task(self.bot._delete_worker())
+
+    async def asyncTearDown(self):
+        self.worker.cancel()
+        self.tmp.cleanup()
+
+    async def delete(self, message):
+        self.bot._queue_delete(message)
+        await asyncio.wait_for(self.bot._delete_q.join(), 1)
+
+    async def test_worker_survives_network_error(self):
+        await self.delete(FakeMessage(10, ConnectionResetError("reset by peer")))
+        self.assertFalse(self.worker.done())
+
+        message = FakeMessage(11)
+        await self.delete(message)
+        self.assertTrue(message.deleted)
+
+
+class RateLimitFilterTests(unittest.TestCase):
+
+    def test_429_warning_slows_deletes(self):
+        counting_bot = CountingBot(1, 2)
+        before = counting_bot._delete_delay
+        # Format of the warning discord.py's HTTP client logs for every 429
+        record = logging.LogRecord(
+            "discord.http", logging.WARNING, __file__, 0,
+            "We are being rate limited. %s %s responded with 429. Retrying in %.2f seconds.",
+            ("DELETE", "https://discord.com/api/v10/channels/2/messages/10", 1.5), None,
+        )
+        self.assertTrue(counting_bot._rate_limit_filter.filter(record))
+        self.assertAlmostEqual(counting_bot._delete_delay, before + bot.DELETE_DELAY_STEP_UP)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+"""
+Tests for the counting rules and for persisting counting state from several
+instances sharing one database.
+Run with: python -m unittest discover tests
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiosqlite
+
+import bot
+import counting_core
+from bot import CountingBot
+
+SERVER_ID = 1
+CHANNEL_ID = 2
+CHANNEL = SimpleNamespace(id=CHANNEL_ID, guild=SimpleNamespace(id=SERVER_ID))
+
+
+def make_message(message_id: int, content: str, author_id: int):
+    """Build a stand-in for a discord.Message in the counting channel."""
+    author = SimpleNamespace(id=author_id, bot=False)
+    return SimpleNamespace(id=message_id, content=content, author=author, channel=CHANNEL)
+
+
+class RuleTests(unittest.TestCase):
+    """counting_core.is_count and validate enforce the counting rules."""
+
+    def test_is_count(self):
+        cases = [
+            ("5", True),
+            ("123", True),
+            ("", False),
+            (" 5", False),
+            ("5 ", False),
+            ("5\n", False),
+            ("-5", False),
+            ("5a", False),
+            ("\u0665", False),  # Arabic-Indic five
+            ("\uff15", False),  # Fullwidth five
+        ]
+        for content, expected in cases:
+            with self.subTest(content=content):
+                self.assertEqual(counting_core.is_count(content), expected)
+
+    def test_validate(self):
+        # (content, expected next count, previous author, author, valid)
+        cases = [
+            ("6", "6", 1, 2, True),
+            ("7", "6", 1, 2, False),
+            ("5", "6", 1, 2, False),
+            ("06", "6", 1, 2, False),
+            (" 6", "6", 1, 2, False),
+            ("6 ", "6", 1, 2, False),
+            ("\uff16", "6", 1, 2, False),
+            ("6", "6", 2, 2, False),
+            ("6", "6", None, 2, True),
+        ]
+        for content, expected, previous_author, author, valid in cases:
+            with self.subTest(content=content, previous_author=previous_author, author=author):
+                self.assertEqual(counting_core.validate(content, expected, previous_author, author), valid)
+
+
+class ReconcileTests(unittest.TestCase):
+    """counting_core.reconcile locates the stored state among local counts."""
+
+    def test_stored_state_matches_accepted_message(self):
+        accepted = [(5, 10), (6, 11), (7, 12)]
+        self.assertEqual(counting_core.reconcile(accepted, 5, 10), 1)
+        self.assertEqual(counting_core.reconcile(accepted, 7, 12), 3)
+
+    def test_stored_state_is_a_different_message(self):
+        self.assertEqual(counting_core.reconcile([(5, 10), (6, 11)], 5, 99), -1)
+
+    def test_stored_state_is_ahead(self):
+        self.assertEqual(counting_core.reconcile([(5, 10)], 6, 11), -1)
+
+
+class LostSwapTests(unittest.IsolatedAsyncioTestCase):
+    """Two bots watching the same channel and sharing one state database."""
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, "state.db")
+        self.a = CountingBot(SERVER_ID, CHANNEL_ID, path)
+        self.b = CountingBot(SERVER_ID, CHANNEL_ID, path)
+        for bot in (self.a, self.b):
+            await bot._load_state()
+
+    async def asyncTearDown(self):
+        for bot in (self.a, self.b):
+            await bot._db.close()
+        self.tmp.cleanup()
+
+    async def deliver(self, message, *bots):
+        """Hand a message to each bot in turn, letting each save finish."""
+        for bot in bots:
+            await bot._handle_message(message)
+            await bot._save_task
+
+    def fail_next(self, counting_bot, statement: str):
+        """Make the bot's next database statement starting with `statement` fail.
+        
+        Returns an event set once the failure has happened.
+        """
+        failed = asyncio.Event()
+        execute = counting_bot._db.execute
+        
+        def flaky_execute(sql, *args):
+            if not failed.is_set() and sql.startswith(statement):
+                failed.set()
+                raise aiosqlite.OperationalError("database is locked")
+            return execute(sql, *args)
+        
+        patcher = mock.patch.object(counting_bot._db, "execute", flaky_execute)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return failed
+
+    async def stored(self):
+        async with self.a._db.execute("SELECT count, last_message FROM state") as cursor:
+            return await cursor.fetchone()
+
+    async def test_losing_replica_keeps_messages_the_winner_accepted(self):
+        await self.deliver(make_message(9, "4", 100), self.a, self.b)
+        await self.deliver(make_message(10, "5", 101), self.a, self.b)
+        await self.deliver(make_message(11, "6", 102), self.b, self.a)
+        await self.deliver(make_message(12, "7", 103), self.a, self.b)
+
+        for bot in (self.a, self.b):
+            self.assertTrue(bot._delete_q.empty())
+            self.assertEqual(bot.count, 7)
+            self.assertEqual(bot.previous_author_id, 103)
+        self.assertEqual(await self.stored(), (7, 12))
+
+    async def test_losing_replica_extends_stored_state(self):
+        await self.deliver(make_message(9, "4", 100), self.a, self.b)
+        await self.deliver(make_message(10, "5", 101), self.a)
+        # B accepts two counts before its save runs, one ahead of A
+        await self.b._handle_message(make_message(10, "5", 101))
+        await self.b._handle_message(make_message(11, "6", 102))
+        await self.b._save_task
+
+        self.assertTrue(self.b._delete_q.empty())
+        self.assertEqual(self.b.count, 6)
+        self.assertEqual(await self.stored(), (6, 11))
+
+    @mock.patch.object(bot, "SAVE_RETRY_DELAY", 0.2)
+    async def test_failed_save_is_retried_and_reconciled(self):
+        await self.deliver(make_message(9, "4", 100), self.a, self.b)
+        failed = self.fail_next(self.a, "UPDATE")
+        await self.a._handle_message(make_message(10, "5", 101))
+        await failed.wait()
+        # B stores 5 and 6 while A waits to retry its failed write
+        await self.deliver(make_message(10, "5", 101), self.b)
+        six = make_message(11, "6", 102)
+        await self.a._handle_message(six)
+        await self.deliver(six, self.b)
+        await self.a._save_task
+
+        self.assertTrue(self.a._delete_q.empty())
+        self.assertEqual(self.a.count, 6)
+        self.assertEqual(await self.stored(), (6, 11))
+
+    @mock.patch.object(bot, "SAVE_RETRY_DELAY", 0.01)
+    async def test_failed_reload_keeps_accepted_counts(self):
+        await self.deliver(make_message(9, "4", 100), self.a, self.b)
+        await self.deliver(make_message(10, "5", 101), self.b)
+        # A loses the swap for 5 and cannot read the stored state
+        failed = self.fail_next(self.a, "SELECT")
+        await self.a._handle_message(make_message(10, "5", 101))
+        await failed.wait()
+        await self.a._handle_message(make_message(11, "6", 102))
+        await self.a._save_task
+
+        self.assertTrue(self.a._delete_q.empty())
+        self.assertEqual(self.a.count, 6)
+        self.assertEqual(await self.stored(), (6, 11))
+
+    async def test_conflicting_count_is_deleted(self):
+        await self.deliver(make_message(9, "4", 100), self.a, self.b)
+        # Each bot saw a different message for the same count
+        await self.deliver(make_message(10, "5", 101), self.a)
+        rejected = make_message(20, "5", 201)
+        await self.deliver(rejected, self.b)
+
+        self.assertIs(self.b._delete_q.get_nowait(), rejected)
+        self.assertEqual(self.b.count, 5)
+        self.assertEqual(self.b.previous_author_id, 101)
+        self.assertEqual(await self.stored(), (5, 10))
+
+    async def test_zero_and_leading_zeros_do_not_initialize(self):
+        await self.a._handle_message(make_message(8, "0", 100))
+        await self.a._handle_message(make_message(9, "007", 100))
+        self.assertIsNone(self.a.count)
+
+        await self.deliver(make_message(10, "7", 100), self.a)
+        self.assertEqual(self.a.count, 7)
+
+
+if __name__ == "__main__":
+    unittest.main()